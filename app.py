@@ -2,28 +2,127 @@
 Anonymous room-based chat app (single-file)
 
 Requirements:
-  pip install fastapi uvicorn
+  pip install fastapi "uvicorn[standard]>=0.35" "websockets>=13" msgspec
 
 Run:
-  uvicorn anonymous_chat:app --reload
+  uvicorn anonymous_chat:app --reload --ws-max-size 16384
 
 Open in browser: http://127.0.0.1:8000/   (append ?room=roomname to join a room or use the UI to create one)
 
 This is intentionally minimalistic and anonymous: no accounts, no private messages.
 """
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, Response
 from fastapi.staticfiles import StaticFiles
 import asyncio
-import secrets
-import json
-from collections import defaultdict
+import contextlib
+import hashlib
+import logging
+import os
+import msgspec
 
 app = FastAPI()
+log = logging.getLogger(__name__)
+
+# reusable codec instances; broadcasts go out as pre-encoded UTF-8 bytes
+_encoder = msgspec.json.Encoder()
+_decoder = msgspec.json.Decoder(dict)
+
+# fixed-shape system messages; nicks are always "Anon-<hex>" so they need no JSON escaping
+_JOIN_TMPL = b'{"type":"system","nick":"System","color":"#666","system":"join","text":"%s joined."}'
+_LEAVE_TMPL = b'{"type":"system","nick":"System","color":"#666","system":"leave","text":"%s left."}'
+
+# every possible avatar colour, shared by all connections
+_PALETTE = tuple(f"hsl({h} 70% 55%)" for h in range(360))
+
+
+class Room:
+    """Members of one room, as a dense list of sockets.
+
+    Each socket remembers its slot in `_room_idx`; removal swaps the last member
+    into the freed slot so the list stays dense.
+    """
+    __slots__ = ('ws',)
+
+    def __init__(self):
+        self.ws = []
+
+    def __len__(self):
+        return len(self.ws)
+
+    def index(self, ws):
+        """Slot of `ws` in this room, or None if it isn't a member."""
+        idx = getattr(ws, '_room_idx', None)
+        if idx is not None and idx < len(self.ws) and self.ws[idx] is ws:
+            return idx
+        return None
+
+    def add(self, ws):
+        ws._room_idx = len(self.ws)
+        self.ws.append(ws)
+
+    def remove(self, ws):
+        """Remove `ws`; returns False if it wasn't a member."""
+        idx = self.index(ws)
+        if idx is None:
+            return False
+        moved = self.ws.pop()
+        if moved is not ws:
+            self.ws[idx] = moved
+            moved._room_idx = idx
+        del ws._room_idx
+        return True
+
 
 # In-memory room manager. For a production app you'd want persistent storage and better resource controls.
-rooms = defaultdict(dict)  # room_name -> {ws: {nick, color}}
-rooms_lock = asyncio.Lock()
+# No lock needed: everything runs on a single event-loop thread and all `rooms`
+# mutations happen synchronously between awaits, so no other task can observe
+# a half-done update. Keep it that way (snapshot before awaiting, never await mid-mutation).
+#
+# Rooms are created explicitly on join and only ever read with rooms.get(). Every
+# registered member's endpoint is inside the try/finally that unregisters it, and
+# whichever endpoint leaves a room empty pops it, so rooms can't outlive their members.
+# A broadcast may evict members early; the room is still popped by the last endpoint out.
+rooms: dict[str, Room] = {}  # room_name -> Room
+SEND_TIMEOUT = 5.0  # seconds before a stuck client is dropped from a broadcast
+MAX_CONCURRENT_SENDS = 128
+# Per-connection transport buffer, a quarter of asyncio's 64 KiB default. uvicorn's
+# send() waits while the buffer is over the high mark, so a reader that can't keep
+# up blocks its sends and gets dropped by SEND_TIMEOUT instead of piling up frames.
+WRITE_BUFFER_HIGH = 16 * 1024
+WRITE_BUFFER_LOW = 4 * 1024
+WS_MAX_SIZE = 16 * 1024  # largest frame the server will accept (enforced by uvicorn)
+MAX_MESSAGE_SIZE = 8192  # inbound frames longer than this are ignored
+MAX_PER_ROOM = 5000
+MAX_MSG_BATCH = 16  # chat messages coalesced into one broadcast during a burst
+ROOMS_PUSH_DELAY = 0.5  # seconds; room-list changes within this window share one fanout
+BROADCAST_BATCH_SIZE = 50
+BROADCAST_SEM = asyncio.Semaphore(MAX_CONCURRENT_SENDS)  # caps in-flight sends across all broadcasts
+
+# Encoded {'type': 'rooms'} frame. The active-room set only changes when a room gains
+# its first member or loses its last one, so the frame is rebuilt only after those.
+_rooms_frame = None
+_rooms_cache = None  # encoded GET /rooms body, same invalidation
+
+
+def active_rooms():
+    # only list rooms with at least 1 connection
+    return [r for r, m in rooms.items() if m.ws]
+
+
+def rooms_changed():
+    """Invalidate cached room-list payloads; call whenever the active-room set changes."""
+    global _rooms_frame, _rooms_cache
+    _rooms_frame = None
+    _rooms_cache = None
+
+
+def rooms_frame() -> bytes:
+    global _rooms_frame
+    if _rooms_frame is None:
+        _rooms_frame = _encoder.encode({'type': 'rooms', 'rooms': active_rooms()})
+    return _rooms_frame
+
 
 HTML = r'''<!doctype html>
 <html>
@@ -109,6 +208,7 @@ HTML = r'''<!doctype html>
   const sendBtn = document.getElementById('sendBtn');
 
   let ws = null;
+  const utf8 = new TextDecoder();
   let me = null;
   const roomsSeen = new Set();
 
@@ -143,12 +243,14 @@ HTML = r'''<!doctype html>
     setRoom(r);
     const loc = (location.protocol === 'https:' ? 'wss://' : 'ws://') + location.host + '/ws?room=' + encodeURIComponent(r);
     ws = new WebSocket(loc);
+    ws.binaryType = 'arraybuffer';
     ws.addEventListener('open', ()=>{ console.log('ws open'); });
     ws.addEventListener('message', ev=>{
-      try{ const payload = JSON.parse(ev.data);
+      try{ const payload = JSON.parse(typeof ev.data === 'string' ? ev.data : utf8.decode(ev.data));
         if(payload.type === 'meta'){ me = payload.you; userMeta.textContent = 'You: ' + me.nick; }
         if(payload.type === 'rooms'){ updateRooms(payload.rooms); }
         if(payload.type === 'msg' || payload.type === 'system'){ pushMsg(makeBubble(payload)); }
+        if(payload.type === 'msg_batch'){ payload.items.forEach(m=>pushMsg(makeBubble(m))); }
       }catch(e){ console.error(e); }
     });
     ws.addEventListener('close', ()=>{ pushMsg(makeBubble({nick:'System', text:'Disconnected.', color:'#333', system:'status'})); });
@@ -171,100 +273,236 @@ HTML = r'''<!doctype html>
 </html>
 '''
 
+# the page never changes at runtime, so encode and fingerprint it once
+_HTML_BYTES = HTML.encode('utf-8')
+_HTML_ETAG = '"' + hashlib.sha256(_HTML_BYTES).hexdigest()[:16] + '"'
+_HTML_HEADERS = {"ETag": _HTML_ETAG, "Cache-Control": "public, max-age=60"}
+
+
+def get_transport(ws: WebSocket):
+    """Best-effort access to the asyncio transport behind `ws`, or None.
+
+    ASGI doesn't expose it. Starlette wraps `send` but passes uvicorn's `receive`
+    through untouched, and that is a method of the protocol object, which keeps
+    the transport on `.transport`. Any middleware wrapping `receive` hides it.
+    """
+    protocol = getattr(getattr(ws, '_receive', None), '__self__', None)
+    return getattr(protocol, 'transport', None)
+
+
 async def broadcast(room: str, message: dict):
     """Send message JSON to all connections in the room."""
-    to_remove = []
-    async with rooms_lock:
-        conns = list(rooms[room].keys())
-    for ws in conns:
+    # encode once for the whole room, not once per recipient
+    await broadcast_bytes(room, _encoder.encode(message))
+
+
+async def dispatch_messages(websocket: WebSocket, room: str, inbox: asyncio.Queue):
+    """Broadcast one connection's chat messages, coalescing whatever piled up.
+
+    While a broadcast is in flight the receive loop keeps queueing; the next
+    round sends everything waiting (up to MAX_MSG_BATCH) as one msg_batch frame.
+    Returns once it takes the None sentinel, after everything queued before it
+    has gone out.
+    """
+    failed = False
+    done = False
+    while not done:
+        items = []
+        item = await inbox.get()
+        while item is not None:
+            items.append(item)
+            if len(items) >= MAX_MSG_BATCH or inbox.empty():
+                break
+            item = inbox.get_nowait()
+        done = item is None
+        if failed or not items:
+            continue
         try:
-            await ws.send_text(json.dumps(message))
+            if len(items) == 1:
+                await broadcast(room, items[0])
+            else:
+                await broadcast(room, {'type': 'msg_batch', 'items': items})
         except Exception:
-            # mark for removal
-            to_remove.append(ws)
+            # don't die quietly: a dead dispatcher would leave the receive loop
+            # blocked on a full inbox. Drop the client and keep draining until the
+            # sentinel so the endpoint's cleanup still runs.
+            log.exception("dispatching messages for room %r failed", room)
+            failed = True
+            with contextlib.suppress(Exception):
+                await websocket.close(code=1011)
+
+
+async def broadcast_bytes(room: str, payload: bytes):
+    """Send an already-encoded JSON payload to all connections in the room."""
+    members = rooms.get(room)
+    if members is None:
+        return
+    conns = list(members.ws)
+
+    async def _one(ws):
+        # returns the socket if the send failed so it can be removed
+        if members.index(ws) is None:
+            return None  # already left, or evicted by a concurrent broadcast
+        async with BROADCAST_SEM:
+            try:
+                await asyncio.wait_for(ws.send_bytes(payload), SEND_TIMEOUT)
+                return None
+            except Exception:
+                pass
+        # stuck or broken: close it too, so its own endpoint loop ends and cleans up.
+        # Done after releasing the semaphore so a dead client doesn't hold a permit longer.
+        with contextlib.suppress(Exception):
+            await asyncio.wait_for(ws.close(code=1013), SEND_TIMEOUT)
+        return ws
+
+    # send to everyone concurrently so one slow client doesn't stall the rest;
+    # huge rooms go out in batches with a yield in between so other tasks get to run
+    to_remove = []
+    for i in range(0, len(conns), BROADCAST_BATCH_SIZE):
+        batch = conns[i:i + BROADCAST_BATCH_SIZE]
+        results = await asyncio.gather(*(_one(ws) for ws in batch))
+        to_remove.extend(ws for ws in results if ws is not None)
+        if len(conns) > BROADCAST_BATCH_SIZE:
+            await asyncio.sleep(0)
     if to_remove:
-        async with rooms_lock:
-            for ws in to_remove:
-                if ws in rooms[room]:
-                    del rooms[room][ws]
+        for ws in to_remove:
+            members.remove(ws)
+        if not members.ws:
+            rooms_changed()
+
+
+async def broadcast_all(payload: bytes):
+    """Send an already-encoded payload to every connection in every room."""
+    await asyncio.gather(*(broadcast_bytes(r, payload) for r in list(rooms)))
+
+
+_rooms_push = None  # pending push_rooms() task, if any
+
+
+def schedule_rooms_push():
+    """Push the room list to everyone soon, coalescing bursts of room changes.
+
+    Each push reaches every connection, so a burst of rooms appearing and
+    disappearing (e.g. many aborted connections) must not cost one each.
+    """
+    global _rooms_push
+    if _rooms_push is None:
+        _rooms_push = asyncio.create_task(push_rooms())
+
+
+async def push_rooms():
+    global _rooms_push
+    try:
+        await asyncio.sleep(ROOMS_PUSH_DELAY)
+    finally:
+        # changes from here on need a new push; this one sends the latest list
+        _rooms_push = None
+    await broadcast_all(rooms_frame())
 
 
 @app.get("/", response_class=HTMLResponse)
 async def get_index(request: Request):
-    return HTML
+    if request.headers.get("if-none-match") == _HTML_ETAG:
+        return Response(status_code=304, headers=_HTML_HEADERS)
+    return Response(content=_HTML_BYTES, media_type="text/html", headers=_HTML_HEADERS)
 
 
 @app.get('/rooms')
 async def list_rooms():
-    async with rooms_lock:
-        # only list rooms with at least 1 connection
-        active = [r for r, m in rooms.items() if len(m) > 0]
-    return {"rooms": active}
+    global _rooms_cache
+    if _rooms_cache is None:
+        _rooms_cache = _encoder.encode({"rooms": active_rooms()})
+    return Response(_rooms_cache, media_type="application/json")
 
 
 @app.websocket('/ws')
 async def websocket_endpoint(websocket: WebSocket):
     # join by query param: /ws?room=roomname
     await websocket.accept()
+    transport = get_transport(websocket)
+    if transport is not None:
+        # TCP_NODELAY needs no tuning here: asyncio and uvloop set it on every TCP transport
+        transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH, low=WRITE_BUFFER_LOW)
     q = websocket.query_params
     room = q.get('room', 'lobby') or 'lobby'
+    members = rooms.get(room)
+    if members is not None and len(members) >= MAX_PER_ROOM:
+        await websocket.close(code=1013)
+        return
 
     # create anonymous identity
-    nick = f"Anon-{secrets.token_hex(2)}"
-    color = f"hsl({secrets.randbelow(360)} 70% 55%)"
+    # one entropy read: 2 bytes for the nick, 2 bytes for the hue
+    b = os.urandom(4)
+    nick = f"Anon-{b[:2].hex()}"
+    hue = int.from_bytes(b[2:], 'big') % 360
+    color = _PALETTE[hue]
     info = {'nick': nick, 'color': color}
 
-    # register
-    async with rooms_lock:
-        rooms[room][websocket] = info
-
-    # send metadata to this client
-    await websocket.send_text(json.dumps({'type': 'meta', 'you': info}))
-    # notify room of join
-    await broadcast(room, {'type': 'system', 'text': f"{nick} joined.", 'nick': 'System', 'color': '#666', 'system': 'join'})
-    # update room list for all clients
-    async with rooms_lock:
-        room_list = [r for r, m in rooms.items() if len(m) > 0]
-    await broadcast(room, {'type': 'rooms', 'rooms': room_list})
+    # register; from here on every await sits inside the try so the finally
+    # always unregisters us, even if the client drops during the handshake sends
+    created = not members
+    if members is None:
+        members = rooms[room] = Room()
+    members.add(websocket)
+    if created:
+        rooms_changed()
 
+    dispatcher = None
     try:
+        # send metadata to this client
+        await websocket.send_bytes(_encoder.encode({'type': 'meta', 'you': info}))
+        # notify room of join
+        await broadcast_bytes(room, _JOIN_TMPL % nick.encode())
+        await websocket.send_bytes(rooms_frame())
+        if created:
+            # a new room appeared: everyone else's room list needs updating too
+            schedule_rooms_push()
+
+        # bounded, so a client flooding faster than we can fan out gets backpressure
+        inbox = asyncio.Queue(maxsize=4 * MAX_MSG_BATCH)
+        dispatcher = asyncio.create_task(dispatch_messages(websocket, room, inbox))
         while True:
             data = await websocket.receive_text()
+            if len(data) > MAX_MESSAGE_SIZE:
+                continue
             try:
-                payload = json.loads(data)
-            except Exception:
+                payload = _decoder.decode(data)
+            except msgspec.DecodeError:
                 payload = {'type': 'msg', 'text': data}
 
             if payload.get('type') == 'msg':
                 text = payload.get('text', '')[:2000]
-                sender = rooms[room].get(websocket, info)
-                msg = {'type': 'msg', 'text': text, 'nick': sender['nick'], 'color': sender['color']}
-                await broadcast(room, msg)
+                # identity is fixed for the life of the connection, no lookup needed
+                msg = {'type': 'msg', 'text': text, 'nick': nick, 'color': color}
+                await inbox.put(msg)
     except WebSocketDisconnect:
         pass
     except Exception:
         pass
     finally:
-        # cleanup
-        async with rooms_lock:
-            if websocket in rooms[room]:
-                left = rooms[room][websocket]['nick']
-                del rooms[room][websocket]
-            else:
-                left = 'Someone'
-            if len(rooms[room]) == 0:
-                try:
-                    del rooms[room]
-                except KeyError:
-                    pass
-        await broadcast(room, {'type': 'system', 'text': f"{left} left.", 'nick': 'System', 'color': '#666', 'system': 'leave'})
-        async with rooms_lock:
-            room_list = [r for r, m in rooms.items() if len(m) > 0]
-        # broadcast updated rooms to remaining members in the room
-        if room in rooms:
-            await broadcast(room, {'type': 'rooms', 'rooms': room_list})
+        # cleanup: let anything already queued go out before this member leaves
+        if dispatcher is not None:
+            await inbox.put(None)
+            await dispatcher
+        # a failed broadcast may already have dropped us; either way we know who left
+        members.remove(websocket)
+        removed = len(members) == 0 and rooms.get(room) is members
+        if removed:
+            rooms.pop(room, None)
+            rooms_changed()
+            # the room is gone, so nobody is left to see the leave notice;
+            # the only fanout needed is the updated room list for everyone else
+            schedule_rooms_push()
+        else:
+            await broadcast_bytes(room, _LEAVE_TMPL % nick.encode())
 
 
 if __name__ == '__main__':
+    import sys
     import uvicorn
-    uvicorn.run('app:app', host='0.0.0.0', port=8000, reload=True)
+    # uvloop + httptools (from uvicorn[standard]); uvloop isn't available on Windows
+    loop = 'auto' if sys.platform == 'win32' else 'uvloop'
+    uvicorn.run('app:app', host='0.0.0.0', port=8000, loop=loop, http='httptools',
+                # websockets' sans-I/O protocol: C speedups for frame masking, and not
+                # the deprecated legacy 'websockets' backend
+                ws='websockets-sansio', ws_max_size=WS_MAX_SIZE, reload=True)